@@ -1,169 +1,974 @@
 #!/usr/bin/env python3
 """
 Script that:
-1) reads a .env file for OpenAI configuration,
-2) runs `tshark -r <file> -T json` on the supplied trace file,
-3) splits the packets into batches and analyzes each batch separately,
+1) starts `tshark -r <file> -T ek` on the supplied trace file,
+2) reads OpenAI configuration from a .env file and/or environment variables,
+3) packs the packets into token-bounded batches and analyzes them concurrently,
 4) creates a final summary of all partial analyses,
 5) saves summary to summary.txt and details to details.txt
 
 Usage:
-    python ai_pcap_explain.py <trace_file> [prompt] [--batch-size N]
+    python ai_pcap_explain.py <trace_file> [prompt] [--max-prompt-tokens N] [--batch-size N]
+                              [--concurrency N] [--batch-api]
 
 If *prompt* is omitted, the script falls back to its default explanatory prompt.
 """
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import importlib.util
 import json
 import os
+import pathlib
+import re
 import subprocess
 import sys
+import tempfile
+import time
 
 try:
-    from openai import OpenAI
+    import httpx
+    import openai
+    from openai import AsyncOpenAI
 except ImportError:
     print("❌  Missing dependency: install with `pip install openai`", file=sys.stderr)
     sys.exit(1)
 
+try:
+    from tenacity import (
+        retry,
+        retry_if_exception_type,
+        stop_after_attempt,
+        wait_random_exponential,
+    )
+except ImportError:
+    print("❌  Missing dependency: install with `pip install tenacity`", file=sys.stderr)
+    sys.exit(1)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # fall back to the (slower) stdlib json module
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None  # fall back to a rough characters-per-token estimate
+
+# Reply token caps: batch analyses scale with the number of packets, partial
+# summaries are kept short like a batch analysis (they are fed into the next
+# level), the final summary may be as long as its input but never longer than
+# SUMMARY_MAX_TOKENS.
+BATCH_MAX_TOKENS_BASE = 1024
+BATCH_MAX_TOKENS_PER_PACKET = 64
+BATCH_MAX_TOKENS_LIMIT = 4096
+PARTIAL_SUMMARY_MAX_TOKENS = 2048
+SUMMARY_MIN_TOKENS = 1024
+SUMMARY_MAX_TOKENS = 8192
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "ai_pcap_explain",
+)
+
+# Static parts of the prompts, built once; the *_USER variants are used when
+# the user supplied a question about the trace.
+BATCH_JSON_HEADER = "JSON dump tej porcji pakietów:\n"
+BATCH_REPEAT_NOTE = (
+    'Wpis {"packet": ..., "repeat": N} oznacza N kolejnych pakietów identycznych '
+    "z podanym, z wyjątkiem czasu, numeru ramki i numerów sekwencyjnych. "
+    "Dla pakietów zawierających samo potwierdzenie TCP (ACK bez danych) wpis "
+    "obejmuje wszystkie takie pakiety danego strumienia TCP w tej porcji, "
+    "w miejscu pierwszego z nich.\n\n"
+)
+BATCH_TEMPLATE_USER = (
+    "\n\n"
+    "Przeanalizuj tę porcję pakietów w kontekście pytania użytkownika. "
+    "Skup się na kluczowych informacjach i wzorcach w tej porcji."
+)
+BATCH_TEMPLATE_DEFAULT = (
+    "\n\n"
+    "Przeanalizuj tę porcję pakietów i opisz co się dzieje w tej części komunikacji. "
+    "Skup się na kluczowych informacjach: protokołach, adresach IP, portach, "
+    "rodzaju komunikacji i wszelkich anomaliach czy wzorcach."
+)
+SUMMARY_ANALYSES_HEADER = "Analizy poszczególnych porcji:\n"
+SUMMARY_TEMPLATE_USER = (
+    "\n\n"
+    "Na podstawie wszystkich analiz cząstkowych, przygotuj kompleksowe podsumowanie "
+    "odpowiadające na pytanie użytkownika. Połącz informacje z wszystkich porcji "
+    "w spójną całość i wyciągnij najważniejsze wnioski."
+)
+SUMMARY_TEMPLATE_DEFAULT = (
+    "\n\n"
+    "Na podstawie wszystkich analiz cząstkowych, przygotuj kompleksowe podsumowanie "
+    "całego ruchu sieciowego. Połącz informacje z wszystkich porcji w spójną całość, "
+    "opisz główne wzorce komunikacji, protokoły, potencjalne problemy czy anomalie. "
+    "Podsumowanie powinno dawać pełny obraz tego co działo się w sieci."
+)
+
+# Shared HTTP connection pool for all OpenAI requests
+HTTP_POOL_SIZE = 32
+HTTP_TIMEOUT = 120  # seconds
+
+REQUIRED_KEYS = ("OPENAI_ENDPOINT", "OPENAI_API_KEY", "MODEL")
+
+# KEY=value, KEY="value" or KEY='value', one per line
+_ENV_RE = re.compile(
+    r"""^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*"""
+    r"""(?:"([^"\n]*)"|'([^'\n]*)'|(.*?))[ \t\r]*$""",
+    re.MULTILINE,
+)
+
+# Fields kept from the verbose lower layers by slim_packet(); any other layer
+# (ARP, DNS, HTTP, TLS, ...) keeps all of its fields minus the noise.
+SLIM_LAYER_FIELDS = {
+    "frame": {"frame.time", "frame.number", "frame.len", "frame.protocols"},
+    "eth": {"eth.src", "eth.dst"},
+    "ip": {"ip.src", "ip.dst", "ip.proto", "ip.ttl"},
+    "ipv6": {"ipv6.src", "ipv6.dst", "ipv6.nxt"},
+    "tcp": {
+        "tcp.srcport", "tcp.dstport", "tcp.stream", "tcp.flags", "tcp.flags.str",
+        "tcp.seq", "tcp.ack", "tcp.len", "tcp.window_size",
+    },
+    "udp": {"udp.srcport", "udp.dstport", "udp.length"},
+}
+SLIM_FIELD_PREFIXES = ("tcp.analysis",)
+
+# The same names as they appear in tshark's ek output (dots become underscores)
+_SLIM_EK_FIELDS = {
+    layer: {name.replace(".", "_") for name in names}
+    for layer, names in SLIM_LAYER_FIELDS.items()
+}
+_SLIM_EK_PREFIXES = tuple(name.replace(".", "_") for name in SLIM_FIELD_PREFIXES)
+
+# Fields (prefixes) that differ between otherwise identical packets, such as
+# keep-alives, retransmissions or ACKs of one flow; ignored by coalesce_duplicates()
+DEDUP_IGNORED_FIELDS = (
+    "frame.time", "frame.number", "ip.id", "ip.checksum",
+    "tcp.seq", "tcp.nxtseq", "tcp.ack", "tcp.analysis.ack", "tcp.time", "tcp.checksum",
+    "udp.checksum",
+)
+_DEDUP_EK_IGNORED = tuple(name.replace(".", "_") for name in DEDUP_IGNORED_FIELDS)
+
+# tcp.flags of a packet with only the ACK flag set, see _pure_ack_stream()
+TCP_FLAG_ACK = 0x010
+
+# Batch API job states after which the job no longer changes
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
 # --------------------------------------------------------------------------- #
 # Helper functions
 # --------------------------------------------------------------------------- #
 
+def json_loads(data):
+    """Decode JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False, sort_keys=False):
+    """Encode *obj* as a JSON string, using orjson when available."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    if indent:
+        return json.dumps(obj, indent=2, sort_keys=sort_keys)
+    return json.dumps(obj, separators=(",", ":"), sort_keys=sort_keys)
+
+
 def load_env_file(env_path=".env"):
-    """Parse a simple .env file (key=value) and return a dict."""
-    env = {}
+    """Parse a simple .env file (key=value) and return a dict.
+
+    A missing file yields an empty dict, so configuration can come from the
+    environment alone; see load_config().
+    """
     if not os.path.isfile(env_path):
-        raise FileNotFoundError(f"Environment file '{env_path}' not found.")
-    with open(env_path, "r", encoding="utf-8") as fh:
-        for line in fh:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            if "=" not in line:
-                continue  # ignore malformed lines
-            key, val = line.split("=", 1)
-            env[key.strip()] = val.strip().strip('"').strip("'")
-    return env
-
-
-def run_tshark(trace_file):
-    """Run tshark and capture JSON output. Returns a string."""
-    if not os.path.isfile(trace_file):
-        raise FileNotFoundError(f"Trace file '{trace_file}' does not exist.")
-    cmd = ["tshark", "-r", trace_file, "-T", "json"]
-    try:
-        result = subprocess.run(
-            cmd,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-    except FileNotFoundError:
-        raise RuntimeError("`tshark` binary not found. Is Wireshark installed?")
-    except subprocess.CalledProcessError as exc:
-        raise RuntimeError(
-            f"`tshark` failed with exit code {exc.returncode}:\n{exc.stderr}"
-        )
-    return result.stdout
+        return {}
+    text = pathlib.Path(env_path).read_text(encoding="utf-8")
+    # Comments and malformed lines simply do not match
+    return {
+        match.group(1): next(val for val in match.group(2, 3, 4) if val is not None)
+        for match in _ENV_RE.finditer(text)
+    }
+
+
+def load_config(env_path=".env", keys=REQUIRED_KEYS):
+    """Return configuration from *env_path*, overridden by environment variables."""
+    cfg = load_env_file(env_path)
+    cfg.update({key: os.environ[key] for key in keys if key in os.environ})
+    return cfg
+
+
+def _is_noise_field(key):
+    """Return True for raw byte dumps and protocol subtrees."""
+    return key.startswith("_") or key.endswith(("_raw", "_tree"))
+
+
+def _strip_noise(value):
+    """Recursively drop noise fields from a decoded tshark value."""
+    if isinstance(value, dict):
+        return {
+            key: _strip_noise(val)
+            for key, val in value.items()
+            if not _is_noise_field(key)
+        }
+    if isinstance(value, list):
+        return [_strip_noise(val) for val in value]
+    return value
+
+
+def _ek_field_name(layer, key):
+    """Normalize an ek field key (e.g. 'ip_ip_src') to 'ip_src'."""
+    prefix = f"{layer}_"
+    if key.startswith(prefix * 2):
+        return key[len(prefix):]
+    return key
+
+
+def slim_packet(packet):
+    """Strip a tshark ek packet down to the fields worth sending to the model.
+
+    Layers listed in SLIM_LAYER_FIELDS are reduced to their whitelisted
+    fields; other layers only lose raw dumps, subtrees and internal fields.
+    """
+    layers = packet.get("layers")
+    if not isinstance(layers, dict):
+        return _strip_noise(packet)
+
+    slim_layers = {}
+    for layer, fields in layers.items():
+        if _is_noise_field(layer):
+            continue
+        wanted = _SLIM_EK_FIELDS.get(layer)
+        if wanted is None or not isinstance(fields, dict):
+            slim_layers[layer] = _strip_noise(fields)
+            continue
+        slim_fields = {}
+        for key, val in fields.items():
+            name = _ek_field_name(layer, key)
+            if name in wanted or name.startswith(_SLIM_EK_PREFIXES):
+                slim_fields[key] = val
+        slim_layers[layer] = slim_fields
+
+    slim = {key: val for key, val in packet.items() if key != "layers"}
+    slim["layers"] = slim_layers
+    return slim
+
+
+class TsharkSession:
+    """A `tshark -T ek` process decoding a single trace file.
+
+    tshark is started as soon as the session is created, so its start-up
+    overlaps with whatever the caller does before reading packets() (e.g.
+    loading configuration). Use as a context manager to make sure the
+    process is cleaned up.
+    """
+
+    def __init__(self, trace_file):
+        if not os.path.isfile(trace_file):
+            raise FileNotFoundError(f"Trace file '{trace_file}' does not exist.")
+        cmd = ["tshark", "-r", trace_file, "-T", "ek"]
+        self._stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=self._stderr,
+                bufsize=1 << 20,
+            )
+        except FileNotFoundError:
+            self._stderr.close()
+            raise RuntimeError("`tshark` binary not found. Is Wireshark installed?")
+
+    def packets(self, slim=True):
+        """Yield the decoded packets one at a time.
+
+        tshark's ek output is newline-delimited JSON, so packets are decoded
+        line by line straight from the stdout pipe and the full output is
+        never buffered in memory. With *slim*, packets are passed through
+        slim_packet().
+        """
+        try:
+            for line in self.proc.stdout:
+                if not line.strip():
+                    continue
+                packet = json_loads(line)
+                if "index" in packet:
+                    continue  # Elasticsearch bulk index metadata line
+                yield slim_packet(packet) if slim else packet
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"Invalid JSON from tshark: {exc}")
+
+        returncode = self.proc.wait()
+        if returncode:
+            self._stderr.seek(0)
+            raise RuntimeError(
+                f"`tshark` failed with exit code {returncode}:\n"
+                f"{self._stderr.read().decode('utf-8', errors='replace')}"
+            )
+
+    def close(self):
+        """Stop tshark if it is still running and release its pipes."""
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _dedup_key(packet):
+    """Return a canonical string identifying *packet* for duplicate detection."""
+    layers = packet.get("layers")
+    if not isinstance(layers, dict):
+        return json_dumps(packet, sort_keys=True)
+    key_layers = {}
+    for layer, fields in layers.items():
+        if isinstance(fields, dict):
+            fields = {
+                key: val
+                for key, val in fields.items()
+                if not _ek_field_name(layer, key).startswith(_DEDUP_EK_IGNORED)
+            }
+        key_layers[layer] = fields
+    return json_dumps(key_layers, sort_keys=True)
+
+
+def coalesce_duplicates(packets):
+    """Merge runs of consecutive duplicate packets.
+
+    Packets that only differ in DEDUP_IGNORED_FIELDS are considered equal. A
+    run of N > 1 such packets is replaced by {"packet": <first>, "repeat": N}.
+    """
+    previous = previous_key = None
+    count = 0
+    for packet in packets:
+        key = _dedup_key(packet)
+        if count and key == previous_key:
+            count += 1
+            continue
+        if count:
+            yield previous if count == 1 else {"packet": previous, "repeat": count}
+        previous, previous_key, count = packet, key, 1
+    if count:
+        yield previous if count == 1 else {"packet": previous, "repeat": count}
+
+
+def packet_count(batch_packets):
+    """Return the number of packets in a batch, counting repeated packets."""
+    return sum(
+        entry["repeat"] if "repeat" in entry and "packet" in entry else 1
+        for entry in batch_packets
+    )
+
+
+def _field_value(fields, layer, name):
+    """Return the value of field *name* (e.g. 'tcp_len') from an ek layer."""
+    for key, val in fields.items():
+        if _ek_field_name(layer, key) == name:
+            return val[0] if isinstance(val, list) and val else val
+    return None
+
 
+def _pure_ack_stream(entry):
+    """Return the TCP stream of a packet carrying only an ACK, else None.
 
-def split_packets_into_batches(tshark_json, batch_size=10):
-    """Split the JSON packet array into smaller batches."""
+    Packets flagged by tshark's TCP analysis (duplicate ACKs, zero windows,
+    keep-alives, ...) are not considered plain ACKs.
+    """
+    packet = entry["packet"] if "repeat" in entry and "packet" in entry else entry
+    layers = packet.get("layers")
+    tcp = layers.get("tcp") if isinstance(layers, dict) else None
+    if not isinstance(tcp, dict) or _field_value(tcp, "tcp", "tcp_analysis_flags") is not None:
+        return None
     try:
-        packets = json.loads(tshark_json)
-    except json.JSONDecodeError as exc:
-        raise ValueError(f"Invalid JSON from tshark: {exc}")
-    
-    if not isinstance(packets, list):
-        raise ValueError("Expected JSON array from tshark")
-    
-    batches = []
-    for i in range(0, len(packets), batch_size):
-        batch = packets[i:i + batch_size]
-        batches.append(batch)
-    
-    return batches
+        flags = int(str(_field_value(tcp, "tcp", "tcp_flags")), 0)
+        length = int(str(_field_value(tcp, "tcp", "tcp_len")))
+    except ValueError:
+        return None
+    if flags != TCP_FLAG_ACK or length != 0:
+        return None
+    return _field_value(tcp, "tcp", "tcp_stream")
 
 
-def build_batch_prompt(batch_packets, batch_num, total_batches, trace_file, user_prompt=None):
-    """Create a prompt string for analyzing a batch of packets."""
-    batch_json = json.dumps(batch_packets, indent=2)
-    
+def _split_repeats(packets, max_packets=None):
+    """Split repeated-packet entries longer than *max_packets* into several."""
+    for packet in packets:
+        repeat = packet_count([packet])
+        if max_packets is None or repeat <= max_packets:
+            yield packet
+            continue
+        while repeat > 0:
+            chunk = min(repeat, max_packets)
+            yield packet["packet"] if chunk == 1 else {"packet": packet["packet"], "repeat": chunk}
+            repeat -= chunk
+
+
+def pack_packets_by_tokens(packets, model, max_tokens=6000, max_packets=None, pretty=False,
+                           collapse_acks=False):
+    """Greedily pack packets into batches of at most *max_tokens* prompt tokens.
+
+    Tokens are counted on each packet's JSON as it appears in the prompt. A
+    packet larger than *max_tokens* on its own gets a batch of its own.
+    *max_packets* optionally caps the number of packets per batch as well;
+    repeated packets (see coalesce_duplicates()) count individually.
+    *pretty* must match the JSON formatting used in the prompts.
+
+    With *collapse_acks*, the plain ACKs of each TCP stream within a batch
+    are merged into the first of them, as a repeated-packet entry.
+    """
+    batch = []
+    batch_tokens = 0
+    batch_packets = 0
+    ack_entries = {}  # TCP stream -> index of its plain-ACK entry in batch
+    for packet in _split_repeats(packets, max_packets):
+        count = packet_count([packet])
+        full = max_packets is not None and batch_packets + count > max_packets
+        stream = _pure_ack_stream(packet) if collapse_acks else None
+        index = ack_entries.get(stream) if stream is not None else None
+        if index is not None and not full:
+            entry = batch[index]
+            if "repeat" in entry and "packet" in entry:
+                merged = {"packet": entry["packet"], "repeat": entry["repeat"] + count}
+                extra = 0
+            else:
+                merged = {"packet": entry, "repeat": 1 + count}
+                extra = (count_tokens(json_dumps(merged, indent=pretty), model)
+                         - count_tokens(json_dumps(entry, indent=pretty), model))
+            if batch_tokens + extra <= max_tokens:
+                batch[index] = merged
+                batch_tokens += extra
+                batch_packets += count
+                continue
+        tokens = count_tokens(json_dumps(packet, indent=pretty), model)
+        if batch and (full or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+            batch_packets = 0
+            ack_entries = {}
+        if stream is not None:
+            ack_entries[stream] = len(batch)
+        batch.append(packet)
+        batch_tokens += tokens
+        batch_packets += count
+    if batch:
+        yield batch
+
+
+def build_batch_prompt(batch_packets, batch_num, total_batches, trace_file, user_prompt=None,
+                       first_packet=1, pretty=False):
+    """Create a prompt string for analyzing a batch of packets.
+
+    *first_packet* is the 1-based number of the batch's first packet in the trace.
+    Packets are embedded as compact JSON unless *pretty* is set.
+    """
+    batch_json = json_dumps(batch_packets, indent=pretty)
+    packet_range = f"{first_packet}-{first_packet + packet_count(batch_packets) - 1}"
+    header = (
+        f"Analizuję plik PCAP '{trace_file}' w porcjach.\n"
+        f"To jest porcja {batch_num}/{total_batches} (pakiety {packet_range}).\n\n"
+    )
+    if any("repeat" in entry for entry in batch_packets):
+        header += BATCH_REPEAT_NOTE
+
     if user_prompt:
-        prompt = (
-            f"Analizuję plik PCAP '{trace_file}' w porcjach.\n"
-            f"To jest porcja {batch_num}/{total_batches} (pakiety {(batch_num-1)*len(batch_packets)+1}-{(batch_num-1)*len(batch_packets)+len(batch_packets)}).\n\n"
-            f"Pytanie użytkownika: {user_prompt}\n\n"
-            f"JSON dump tej porcji pakietów:\n{batch_json}\n\n"
-            "Przeanalizuj tę porcję pakietów w kontekście pytania użytkownika. "
-            "Skup się na kluczowych informacjach i wzorcach w tej porcji."
-        )
-    else:
-        prompt = (
-            f"Analizuję plik PCAP '{trace_file}' w porcjach.\n"
-            f"To jest porcja {batch_num}/{total_batches} (pakiety {(batch_num-1)*len(batch_packets)+1}-{(batch_num-1)*len(batch_packets)+len(batch_packets)}).\n\n"
-            f"JSON dump tej porcji pakietów:\n{batch_json}\n\n"
-            "Przeanalizuj tę porcję pakietów i opisz co się dzieje w tej części komunikacji. "
-            "Skup się na kluczowych informacjach: protokołach, adresach IP, portach, "
-            "rodzaju komunikacji i wszelkich anomaliach czy wzorcach."
-        )
-    
-    return prompt
+        return "".join([
+            header,
+            f"Pytanie użytkownika: {user_prompt}\n\n",
+            BATCH_JSON_HEADER, batch_json, BATCH_TEMPLATE_USER,
+        ])
+    return "".join([header, BATCH_JSON_HEADER, batch_json, BATCH_TEMPLATE_DEFAULT])
 
 
-def build_summary_prompt(batch_analyses, trace_file, user_prompt=None):
-    """Create a prompt for the final summary."""
+def build_batch_prompts(batches, trace_file, user_prompt=None, pretty=False):
+    """Create the prompts for all batches, numbering packets across batches."""
+    prompts = []
+    first_packet = 1
+    for i, batch in enumerate(batches):
+        prompts.append(build_batch_prompt(
+            batch, i+1, len(batches), trace_file, user_prompt, first_packet, pretty
+        ))
+        first_packet += packet_count(batch)
+    return prompts
+
+
+def _batch_range_label(first, last):
+    """Return the label of the batch range (first, last), e.g. '3' or '1-16'."""
+    return str(first) if first == last else f"{first}-{last}"
+
+
+def build_summary_prompt(batch_analyses, trace_file, user_prompt=None, ranges=None):
+    """Create a prompt for the final summary.
+
+    *ranges* holds the (first, last) batch numbers covered by each analysis;
+    by default the analyses are batches 1, 2, 3, ...
+    """
+    if ranges is None:
+        ranges = [(i, i) for i in range(1, len(batch_analyses) + 1)]
     analyses_text = "\n\n".join([
-        f"=== Analiza porcji {i+1} ===\n{analysis}"
-        for i, analysis in enumerate(batch_analyses)
+        f"=== Analiza porcji {_batch_range_label(first, last)} ===\n{analysis}"
+        for (first, last), analysis in zip(ranges, batch_analyses)
     ])
-    
+
     if user_prompt:
-        prompt = (
-            f"Mam analizy poszczególnych porcji pliku PCAP '{trace_file}'.\n"
-            f"Pytanie użytkownika było: {user_prompt}\n\n"
-            f"Analizy poszczególnych porcji:\n{analyses_text}\n\n"
-            "Na podstawie wszystkich analiz cząstkowych, przygotuj kompleksowe podsumowanie "
-            "odpowiadające na pytanie użytkownika. Połącz informacje z wszystkich porcji "
-            "w spójną całość i wyciągnij najważniejsze wnioski."
-        )
-    else:
-        prompt = (
-            f"Mam analizy poszczególnych porcji pliku PCAP '{trace_file}'.\n\n"
-            f"Analizy poszczególnych porcji:\n{analyses_text}\n\n"
-            "Na podstawie wszystkich analiz cząstkowych, przygotuj kompleksowe podsumowanie "
-            "całego ruchu sieciowego. Połącz informacje z wszystkich porcji w spójną całość, "
-            "opisz główne wzorce komunikacji, protokoły, potencjalne problemy czy anomalie. "
-            "Podsumowanie powinno dawać pełny obraz tego co działo się w sieci."
+        return "".join([
+            f"Mam analizy poszczególnych porcji pliku PCAP '{trace_file}'.\n",
+            f"Pytanie użytkownika było: {user_prompt}\n\n",
+            SUMMARY_ANALYSES_HEADER, analyses_text, SUMMARY_TEMPLATE_USER,
+        ])
+    return "".join([
+        f"Mam analizy poszczególnych porcji pliku PCAP '{trace_file}'.\n\n",
+        SUMMARY_ANALYSES_HEADER, analyses_text, SUMMARY_TEMPLATE_DEFAULT,
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    """Return the tiktoken encoding for *model* (cl100k_base if unknown)."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    """Count tokens in *text*, estimating ~4 characters/token without tiktoken."""
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    return len(_get_encoding(model).encode(text, disallowed_special=()))
+
+
+def batch_max_tokens(batch_packets):
+    """Return the reply token cap for a batch analysis (repeats count individually)."""
+    return min(
+        BATCH_MAX_TOKENS_BASE + BATCH_MAX_TOKENS_PER_PACKET * packet_count(batch_packets),
+        BATCH_MAX_TOKENS_LIMIT,
+    )
+
+
+def summary_max_tokens(summary_prompt, model):
+    """Return the reply token cap for the final summary, sized to its prompt."""
+    prompt_tokens = count_tokens(summary_prompt, model)
+    return max(SUMMARY_MIN_TOKENS, min(prompt_tokens, SUMMARY_MAX_TOKENS))
+
+
+def build_chat_request(model, prompt, max_tokens=SUMMARY_MAX_TOKENS):
+    """Return the chat completion request body for a single prompt."""
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,   # keep it factual
+        "max_tokens": max_tokens,
+    }
+
+
+def cache_path(cache_dir, request):
+    """Return the cache file path for a chat completion request body."""
+    key = hashlib.sha256(json_dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def read_cache(cache_dir, request):
+    """Return a cached reply for *request*, or None on a cache miss."""
+    if not cache_dir:
+        return None
+    try:
+        with open(cache_path(cache_dir, request), "rb") as fh:
+            return json_loads(fh.read())["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cache(cache_dir, request, response):
+    """Store a reply for *request* in the cache directory."""
+    if not cache_dir:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as exc:
+        print(f"❌  Błąd tworzenia katalogu {cache_dir}: {exc}", file=sys.stderr)
+        return
+    write_to_file(
+        cache_path(cache_dir, request),
+        json_dumps({"model": request["model"], "response": response}),
+    )
+
+
+def _log_retry(retry_state):
+    """Report a transient OpenAI error before the next attempt."""
+    exc = retry_state.outcome.exception()
+    delay = retry_state.next_action.sleep if retry_state.next_action else 0
+    print(
+        f"\n⚠️  Błąd OpenAI ({type(exc).__name__}), ponawiam za {delay:.0f}s "
+        f"(próba {retry_state.attempt_number + 1})...",
+        file=sys.stderr,
+    )
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+        # Raised unwrapped by the SDK when the connection drops mid-stream
+        httpx.TransportError,
+    )),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+async def _stream_completion(client, request, echo=False):
+    """Stream a chat completion and return (reply text, finish_reason).
+
+    With *echo*, a reply interrupted after part of it was printed is marked
+    as such on stdout, so a retried reply is not mistaken for its continuation.
+    """
+    parts = []
+    finish_reason = None
+    # Retries are handled by the decorator, not by the SDK
+    stream = await client.with_options(max_retries=0).chat.completions.create(
+        **request, stream=True
+    )
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            delta = choice.delta.content
+            if delta:
+                parts.append(delta)
+                if echo:
+                    sys.stdout.write(delta)
+                    sys.stdout.flush()
+    except BaseException:
+        if echo and parts:
+            print("\n\n⚠️  [odpowiedź przerwana]", flush=True)
+        raise
+    return "".join(parts), finish_reason
+
+
+async def ask_openai(client: AsyncOpenAI, model: str, prompt: str, max_tokens=SUMMARY_MAX_TOKENS,
+                     cache_dir=None, echo=False, max_tokens_limit=SUMMARY_MAX_TOKENS):
+    """Send a request to OpenAI and return the assistant's reply.
+
+    The reply is streamed; with *echo*, tokens are written to stdout as they
+    arrive. Rate limits, connection errors (also mid-stream) and server
+    errors are retried with exponential backoff. A reply cut off by
+    *max_tokens* is requested again with a doubled cap (up to
+    *max_tokens_limit*, not when echoing); if it is still cut off, a
+    warning is printed. If *cache_dir* is given, complete replies are cached
+    on disk keyed by the request body (model, prompt, max_tokens,
+    temperature), so repeated runs on the same trace skip identical requests.
+    """
+    request = build_chat_request(model, prompt, max_tokens)
+    cached = read_cache(cache_dir, request)
+    if cached is not None:
+        if echo:
+            print(cached)
+        return cached
+
+    attempt = dict(request)
+    try:
+        content, finish_reason = await _stream_completion(client, attempt, echo)
+        while (finish_reason == "length" and not echo
+               and attempt["max_tokens"] < max_tokens_limit):
+            attempt["max_tokens"] = min(2 * attempt["max_tokens"], max_tokens_limit)
+            content, finish_reason = await _stream_completion(client, attempt)
+    except Exception as exc:
+        raise RuntimeError(f"OpenAI request failed: {exc}")
+    if echo:
+        print()
+    if finish_reason == "length":
+        print(
+            f"\n⚠️  Odpowiedź OpenAI ucięta po {attempt['max_tokens']} tokenach (max_tokens)",
+            file=sys.stderr,
         )
-    
-    return prompt
 
+    # Only complete replies are cached, under the originally requested body
+    if finish_reason == "stop":
+        write_cache(cache_dir, request, content)
+    return content
 
-def ask_openai(client: OpenAI, model: str, prompt: str):
-    """Send a request to OpenAI and return the assistant's reply."""
+
+async def analyze_batches(client, model, batches, prompts, concurrency=8, cache_dir=None,
+                          on_result=None):
+    """Analyze all batches concurrently and return the analyses in batch order.
+
+    *prompts* holds the prompt for each batch, see build_batch_prompts().
+    *on_result(index, analysis)* is called as soon as each batch completes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    total = len(batches)
+
+    async def sem_call(i, batch):
+        prompt = prompts[i]
+        async with semaphore:
+            try:
+                analysis = await ask_openai(
+                    client, model, prompt, batch_max_tokens(batch), cache_dir,
+                    max_tokens_limit=BATCH_MAX_TOKENS_LIMIT,
+                )
+            except Exception as exc:
+                raise RuntimeError(f"Błąd analizy porcji {i+1}: {exc}")
+        if on_result is not None:
+            on_result(i, analysis)
+        return analysis
+
+    tasks = [asyncio.ensure_future(sem_call(i, batch)) for i, batch in enumerate(batches)]
+    progress = ProgressBar(total)
+    progress.update(0)
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,   # keep it factual
-            max_tokens=8192,
+        for done, next_done in enumerate(asyncio.as_completed(tasks), 1):
+            await next_done
+            progress.update(done)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    # gather() returns results in input order, regardless of completion order
+    return await asyncio.gather(*tasks)
+
+
+async def analyze_batches_batch_api(client, model, batches, prompts, poll_interval=30,
+                                    cache_dir=None, on_result=None):
+    """Analyze all batches with a single OpenAI Batch API job.
+
+    Batch jobs are billed at a discount and have separate rate limits, at the
+    cost of latency (the job may take up to the 24h completion window).
+    Only batches missing from the cache are submitted. *on_result(index,
+    analysis)* is called for every batch once all results are available.
+    Returns the analyses in batch order.
+    """
+    total = len(batches)
+    progress = ProgressBar(total)
+    requests = [
+        build_chat_request(model, prompt, batch_max_tokens(batch))
+        for batch, prompt in zip(batches, prompts)
+    ]
+    analyses = [read_cache(cache_dir, request) for request in requests]
+    pending = [i for i, analysis in enumerate(analyses) if analysis is None]
+    if not pending:
+        progress.update(total)
+        _report_results(analyses, on_result)
+        return analyses
+
+    lines = []
+    for i in pending:
+        lines.append(json_dumps({
+            "custom_id": f"batch-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": requests[i],
+        }))
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+
+    try:
+        input_file = await client.files.create(
+            file=("requests.jsonl", payload), purpose="batch"
+        )
+        job = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
         )
     except Exception as exc:
-        raise RuntimeError(f"OpenAI request failed: {exc}")
+        raise RuntimeError(f"OpenAI batch submission failed: {exc}")
+
+    print(f"📨 Zadanie wsadowe {job.id} wysłane, czekam na wyniki...")
+    started = time.monotonic()
+    try:
+        while job.status not in BATCH_FINAL_STATUSES:
+            counts = job.request_counts
+            completed = counts.completed if counts else 0
+            progress.update(total - len(pending) + completed)
+            await asyncio.sleep(poll_interval)
+            try:
+                job = await client.batches.retrieve(job.id)
+            except Exception as exc:
+                raise RuntimeError(f"OpenAI batch status check failed: {exc}")
+        progress.update(total)
+
+        if job.status != "completed" or not job.output_file_id:
+            raise RuntimeError(
+                f"Zadanie wsadowe {job.id} zakończone ze statusem '{job.status}'"
+                + _format_batch_errors(await _batch_errors(client, job))
+            )
+        print(f"⏱️  Zadanie wsadowe zakończone po {time.monotonic() - started:.0f}s")
+
+        try:
+            output = await client.files.content(job.output_file_id)
+        except Exception as exc:
+            raise RuntimeError(f"OpenAI batch output download failed: {exc}")
+    except BaseException:
+        # Also on Ctrl+C / task cancellation: do not leave a billed job running
+        if job.status not in BATCH_FINAL_STATUSES + ("cancelling",):
+            await _cancel_batch(client, job.id)
+        raise
 
-    return response.choices[0].message.content
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        record = json_loads(line)
+        index = int(record["custom_id"].split("-", 1)[1])
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            error = record.get("error") or response.get("body")
+            raise RuntimeError(f"Błąd analizy porcji {index+1}: {error}")
+        choice = response["body"]["choices"][0]
+        analyses[index] = choice["message"]["content"]
+        if choice.get("finish_reason") == "stop":
+            write_cache(cache_dir, requests[index], analyses[index])
+        else:
+            print(
+                f"\n⚠️  Analiza porcji {index+1} niekompletna "
+                f"(finish_reason: {choice.get('finish_reason')}), nie zapisuję w cache",
+                file=sys.stderr,
+            )
 
+    missing = [str(i+1) for i, analysis in enumerate(analyses) if analysis is None]
+    if missing:
+        raise RuntimeError(
+            f"Brak wyników dla porcji: {', '.join(missing)}"
+            + _format_batch_errors(await _batch_errors(client, job))
+        )
 
-def show_progress_bar(current, total, bar_length=50):
-    """Display an ASCII progress bar."""
-    filled_length = int(bar_length * current // total)
-    bar = '█' * filled_length + '░' * (bar_length - filled_length)
-    percent = 100 * current / total
-    print(f'\r🤖 Analizuję: |{bar}| {percent:.1f}% ({current}/{total})', end='', flush=True)
-    if current == total:
-        print()  # New line when complete
+    _report_results(analyses, on_result)
+    return analyses
+
+
+async def _batch_errors(client, job):
+    """Return the error messages reported for a Batch API job.
+
+    These come from the job itself (e.g. an invalid input file) and from its
+    error file, which holds the requests that failed.
+    """
+    errors = []
+    if job.errors and job.errors.data:
+        for error in job.errors.data:
+            line = f" (linia {error.line})" if error.line is not None else ""
+            errors.append(f"{error.code}{line}: {error.message}")
+    if job.error_file_id:
+        try:
+            content = await client.files.content(job.error_file_id)
+        except Exception as exc:
+            errors.append(f"nie udało się pobrać pliku błędów: {exc}")
+            return errors
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            record = json_loads(line)
+            index = int(record["custom_id"].split("-", 1)[1])
+            response = record.get("response") or {}
+            error = record.get("error") or (response.get("body") or {}).get("error")
+            if isinstance(error, dict):
+                error = error.get("message") or error
+            errors.append(f"porcja {index+1}: {error or response.get('body')}")
+    return errors
+
+
+def _format_batch_errors(errors, limit=5):
+    """Format Batch API error messages for an exception message."""
+    if not errors:
+        return ""
+    shown = "; ".join(errors[:limit])
+    if len(errors) > limit:
+        shown += f"; ... (i {len(errors) - limit} więcej)"
+    return f" – błędy: {shown}"
+
+
+async def _cancel_batch(client, batch_id):
+    """Cancel an unfinished Batch API job, reporting (not raising) failures."""
+    print(f"\n🛑 Anuluję zadanie wsadowe {batch_id}...", file=sys.stderr)
+    try:
+        await client.batches.cancel(batch_id)
+    except Exception as exc:
+        print(f"⚠️  Nie udało się anulować zadania {batch_id}: {exc}", file=sys.stderr)
+
+
+def _report_results(analyses, on_result):
+    """Pass every analysis to *on_result*, if given."""
+    if on_result is not None:
+        for i, analysis in enumerate(analyses):
+            on_result(i, analysis)
+
+
+class DetailsWriter:
+    """Write batch analyses to an open file as soon as they are available.
+
+    Analyses may complete out of order; each one is written once all the
+    preceding batches have been written, so the file stays in batch order.
+    """
+
+    def __init__(self, fh, total):
+        self.fh = fh
+        self.total = total
+        self.ok = True
+        self._next = 0
+        self._pending = {}
+
+    def add(self, index, analysis):
+        """Record the analysis of batch *index* (0-based)."""
+        self._pending[index] = analysis
+        while self.ok and self._next in self._pending:
+            text = self._pending.pop(self._next)
+            try:
+                self.fh.write(
+                    f"=== ANALIZA PORCJI {self._next + 1}/{self.total} ===\n{text}\n\n"
+                )
+                self.fh.flush()
+            except OSError as exc:
+                print(f"\n❌  Błąd zapisu do {self.fh.name}: {exc}", file=sys.stderr)
+                self.ok = False
+            self._next += 1
+
+
+class ProgressBar:
+    """Display an ASCII progress bar on stdout.
+
+    The line is only redrawn when the bar or the displayed percentage
+    changes, so bursts of completed batches do not flood the terminal.
+    """
+
+    def __init__(self, total, bar_length=50):
+        self.total = total
+        self.bar_length = bar_length
+        self._filled = '█' * bar_length
+        self._empty = '░' * bar_length
+        self._last = None
+
+    def update(self, current):
+        """Show *current* out of the total as done."""
+        total = self.total
+        filled_length = self.bar_length * current // total
+        permille = (1000 * current + total // 2) // total
+        state = (filled_length, permille)
+        if state == self._last and current != total:
+            return
+        self._last = state
+
+        end = '\n' if current == total else ''  # New line when complete
+        sys.stdout.write(
+            f'\r🤖 Analizuję: |{self._filled[:filled_length]}{self._empty[filled_length:]}| '
+            f'{permille / 10:.1f}% ({current}/{total}){end}'
+        )
+        sys.stdout.flush()
 
 
 def write_to_file(filename, content):
@@ -177,6 +982,124 @@ def write_to_file(filename, content):
         return False
 
 
+async def reduce_analyses(client, model, analyses, trace_file, user_prompt=None, fanout=16,
+                          concurrency=8, cache_dir=None):
+    """Summarize groups of *fanout* analyses, level by level, until at most
+    *fanout* remain, so that no summary prompt has to hold every analysis.
+
+    Returns (analyses, ranges): the remaining analyses for the final summary
+    and the (first, last) batch numbers each of them covers.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    ranges = [(i, i) for i in range(1, len(analyses) + 1)]
+    level = 0
+
+    async def summarize(group, group_ranges):
+        if len(group) == 1:
+            return group[0]  # nothing to combine
+        prompt = build_summary_prompt(group, trace_file, user_prompt, group_ranges)
+        async with semaphore:
+            return await ask_openai(
+                client, model, prompt, PARTIAL_SUMMARY_MAX_TOKENS, cache_dir,
+                max_tokens_limit=BATCH_MAX_TOKENS_LIMIT,
+            )
+
+    while len(analyses) > fanout:
+        level += 1
+        starts = range(0, len(analyses), fanout)
+        print(
+            f"🧩 Poziom {level}: podsumowania częściowe "
+            f"({len(analyses)} → {len(starts)})..."
+        )
+        analyses = await asyncio.gather(*(
+            summarize(analyses[start:start + fanout], ranges[start:start + fanout])
+            for start in starts
+        ))
+        ranges = [
+            (ranges[start][0], ranges[min(start + fanout, len(ranges)) - 1][1])
+            for start in starts
+        ]
+
+    return analyses, ranges
+
+
+def create_client(endpoint, api_key, concurrency=8):
+    """Create an AsyncOpenAI client sharing one pooled HTTP client.
+
+    All requests go through a single httpx.AsyncClient whose pool is sized
+    for *concurrency*, so TCP/TLS connections are reused between batches.
+    HTTP/2 (multiplexing requests over one connection) is enabled when the
+    `h2` package is installed.
+    """
+    pool_size = max(HTTP_POOL_SIZE, concurrency)
+    http_client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=endpoint.rstrip("/") + "/v1",
+        http_client=http_client,
+    )
+
+
+async def analyze_trace(endpoint, api_key, model, batches, trace_file, user_prompt=None,
+                        concurrency=8, batch_api=False, cache_dir=None, summary_fanout=16,
+                        pretty=False, on_result=None):
+    """Analyze all batches and create the final summary. Returns (analyses, summary).
+
+    *on_result(index, analysis)* is called as each batch analysis completes.
+    """
+    # 4. Initialize OpenAI client
+    client = create_client(endpoint, api_key, concurrency)
+
+    try:
+        # 5. Process batches (Batch API job or parallel requests) with progress bar
+        prompts = build_batch_prompts(batches, trace_file, user_prompt, pretty)
+        if batch_api:
+            print("🚀 Rozpoczynam analizę porcji (OpenAI Batch API)...")
+            batch_analyses = await analyze_batches_batch_api(
+                client, model, batches, prompts,
+                cache_dir=cache_dir, on_result=on_result,
+            )
+        else:
+            print(f"🚀 Rozpoczynam analizę porcji (równolegle: {concurrency})...")
+            batch_analyses = await analyze_batches(
+                client, model, batches, prompts, concurrency, cache_dir, on_result
+            )
+
+        # 6. Generate final summary, streaming it to the screen as it arrives
+        print("🎯 Tworzę końcowe podsumowanie...")
+        try:
+            summary_inputs, summary_ranges = await reduce_analyses(
+                client, model, batch_analyses, trace_file, user_prompt,
+                summary_fanout, concurrency, cache_dir,
+            )
+        except Exception as exc:
+            raise RuntimeError(f"Błąd tworzenia podsumowania: {exc}")
+        summary_prompt = build_summary_prompt(
+            summary_inputs, trace_file, user_prompt, summary_ranges
+        )
+
+        print("\n" + "="*80)
+        print("🎯 KOŃCOWE PODSUMOWANIE ANALIZY")
+        print("="*80)
+        try:
+            final_summary = await ask_openai(
+                client, model, summary_prompt,
+                summary_max_tokens(summary_prompt, model), cache_dir, echo=True,
+            )
+        except Exception as exc:
+            raise RuntimeError(f"Błąd tworzenia podsumowania: {exc}")
+    finally:
+        await client.close()
+
+    return batch_analyses, final_summary
+
+
 # --------------------------------------------------------------------------- #
 # Main entry point
 # --------------------------------------------------------------------------- #
@@ -192,118 +1115,171 @@ def main():
         default=None,
         help="Optional user‑supplied prompt/question about the trace",
     )
+    parser.add_argument(
+        "--max-prompt-tokens",
+        type=int,
+        default=6000,
+        help="Maximum packet JSON tokens per batch prompt (default: 6000)"
+    )
     parser.add_argument(
         "--batch-size",
         type=int,
-        default=10,
-        help="Number of packets per batch (default: 10)"
+        default=None,
+        help="Maximum number of packets per batch, repeated packets included "
+             "(default: no limit)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of batches analyzed in parallel (default: 8)"
+    )
+    parser.add_argument(
+        "--summary-fanout",
+        type=int,
+        default=16,
+        help="Maximum number of analyses combined in one summary prompt; larger "
+             "traces are summarized hierarchically (default: 16)"
+    )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Submit batch analyses as one OpenAI Batch API job "
+             "(cheaper, but may take minutes to hours)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Do not read or write cached OpenAI replies (cache: {CACHE_DIR})"
+    )
+    parser.add_argument(
+        "--full-packets",
+        action="store_true",
+        help="Send complete tshark packets instead of a reduced set of fields"
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Send every packet, instead of merging runs of consecutive duplicates "
+             "and the plain TCP ACKs of each stream within a batch"
+    )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Indent packet JSON in prompts (easier to debug, costs more tokens)"
     )
     args = parser.parse_args()
 
-    # 1. Load env
-    try:
-        cfg = load_env_file()
-    except Exception as exc:
-        print(f"❌  {exc}", file=sys.stderr)
+    if args.concurrency < 1:
+        print("❌  --concurrency musi być >= 1", file=sys.stderr)
         sys.exit(1)
 
-    required_keys = ["OPENAI_ENDPOINT", "OPENAI_API_KEY", "MODEL"]
-    missing = [k for k in required_keys if k not in cfg]
-    if missing:
-        print(
-            f"❌  Missing keys in .env: {', '.join(missing)}",
-            file=sys.stderr,
-        )
+    if args.summary_fanout < 2:
+        print("❌  --summary-fanout musi być >= 2", file=sys.stderr)
         sys.exit(1)
 
-    endpoint = cfg["OPENAI_ENDPOINT"]
-    api_key = cfg["OPENAI_API_KEY"]
-    model = cfg["MODEL"]
+    if args.max_prompt_tokens < 1:
+        print("❌  --max-prompt-tokens musi być >= 1", file=sys.stderr)
+        sys.exit(1)
 
-    # 2. Run tshark
-    try:
-        print(f"🔍 Uruchamiam tshark na pliku '{args.trace_file}'...")
-        tshark_output = run_tshark(args.trace_file)
-    except Exception as exc:
-        print(f"❌  {exc}", file=sys.stderr)
+    if args.batch_size is not None and args.batch_size < 1:
+        print("❌  --batch-size musi być >= 1", file=sys.stderr)
         sys.exit(1)
 
-    # 3. Split into batches
+    # 1. Start tshark first, so that it boots while the configuration is loaded
     try:
-        print(f"📦 Dzielę pakiety na porcje po {args.batch_size}...")
-        batches = split_packets_into_batches(tshark_output, args.batch_size)
-        print(f"📊 Znaleziono {sum(len(batch) for batch in batches)} pakietów w {len(batches)} porcjach")
+        print(f"🔍 Uruchamiam tshark na pliku '{args.trace_file}'...")
+        tshark = TsharkSession(args.trace_file)
     except Exception as exc:
         print(f"❌  {exc}", file=sys.stderr)
         sys.exit(1)
 
-    if not batches:
-        print("❌  Brak pakietów do analizy", file=sys.stderr)
-        sys.exit(1)
+    with tshark:
+        # 2. Load env (.env file, overridden by environment variables)
+        try:
+            cfg = load_config()
+        except Exception as exc:
+            print(f"❌  {exc}", file=sys.stderr)
+            sys.exit(1)
 
-    # 4. Initialize OpenAI client
-    client = OpenAI(api_key=api_key, base_url=endpoint.rstrip("/") + "/v1")
+        missing = [k for k in REQUIRED_KEYS if k not in cfg]
+        if missing:
+            print(
+                f"❌  Missing keys in .env or environment: {', '.join(missing)}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
 
-    # 5. Process each batch with progress bar
-    batch_analyses = []
-    print("🚀 Rozpoczynam analizę porcji...")
-    
-    for i, batch in enumerate(batches):
-        show_progress_bar(i, len(batches))
-        
-        prompt = build_batch_prompt(
-            batch, i+1, len(batches), args.trace_file, args.prompt
-        )
-        
+        endpoint = cfg["OPENAI_ENDPOINT"]
+        api_key = cfg["OPENAI_API_KEY"]
+        model = cfg["MODEL"]
+
+        # 3. Split packets into batches while decoding
         try:
-            analysis = ask_openai(client, model, prompt)
-            batch_analyses.append(analysis)
+            print(f"📦 Dzielę pakiety na porcje do {args.max_prompt_tokens} tokenów...")
+            # The batch count is needed in every prompt, so all batches are collected first
+            packets = tshark.packets(slim=not args.full_packets)
+            if not args.no_dedup:
+                packets = coalesce_duplicates(packets)
+            batches = list(pack_packets_by_tokens(
+                packets, model, args.max_prompt_tokens, args.batch_size, args.pretty,
+                collapse_acks=not args.no_dedup,
+            ))
+            print(f"📊 Znaleziono {sum(packet_count(batch) for batch in batches)} pakietów w {len(batches)} porcjach")
         except Exception as exc:
-            print(f"\n❌  Błąd analizy porcji {i+1}: {exc}", file=sys.stderr)
+            print(f"❌  {exc}", file=sys.stderr)
             sys.exit(1)
-    
-    # Update progress bar to complete
-    show_progress_bar(len(batches), len(batches))
 
-    # 6. Generate final summary
-    print("🎯 Tworzę końcowe podsumowanie...")
-    summary_prompt = build_summary_prompt(batch_analyses, args.trace_file, args.prompt)
-    
+    if not batches:
+        print("❌  Brak pakietów do analizy", file=sys.stderr)
+        sys.exit(1)
+
+    # 4. Open details.txt, batch analyses are written to it as they complete
+    try:
+        details_file = open("details.txt", "w", encoding="utf-8", buffering=1 << 16)
+    except OSError as exc:
+        print(f"❌  Błąd zapisu do details.txt: {exc}", file=sys.stderr)
+        details_file = None
+    details = DetailsWriter(details_file, len(batches)) if details_file else None
+
+    # 5.-6. Analyze batches concurrently and generate final summary
     try:
-        final_summary = ask_openai(client, model, summary_prompt)
+        batch_analyses, final_summary = asyncio.run(
+            analyze_trace(
+                endpoint, api_key, model, batches,
+                args.trace_file, args.prompt, args.concurrency, args.batch_api,
+                None if args.no_cache else CACHE_DIR, args.summary_fanout, args.pretty,
+                details.add if details else None,
+            )
+        )
     except Exception as exc:
-        print(f"❌  Błąd tworzenia podsumowania: {exc}", file=sys.stderr)
+        print(f"\n❌  {exc}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if details_file:
+            details_file.close()
 
-    # 7. Prepare detailed analysis content
-    detailed_content = []
-    for i, analysis in enumerate(batch_analyses, 1):
-        detailed_content.append(f"=== ANALIZA PORCJI {i}/{len(batch_analyses)} ===\n{analysis}")
-    
-    details_text = "\n\n".join(detailed_content)
-
-    # 8. Save to files
+    # 7. Save summary (details have been written during the analysis)
     print("💾 Zapisuję wyniki do plików...")
     
     summary_saved = write_to_file("summary.txt", final_summary)
-    details_saved = write_to_file("details.txt", details_text)
+    details_saved = details is not None and details.ok
     
     if summary_saved:
         print("✅ Podsumowanie zapisane do: summary.txt")
     if details_saved:
         print("✅ Szczegóły zapisane do: details.txt")
 
-    # 9. Display results on screen
-    print("\n" + "="*80)
-    print("🎯 KOŃCOWE PODSUMOWANIE ANALIZY")
-    print("="*80)
-    print(final_summary)
-    
+    # 8. Display details on screen if they could not be saved
+    #    (the summary has already been streamed to the screen)
     if not (summary_saved and details_saved):
         print("\n" + "="*80)
         print("📋 SZCZEGÓŁOWE ANALIZY PORCJI")
         print("="*80)
-        print(details_text)
+        print("\n\n".join(
+            f"=== ANALIZA PORCJI {i}/{len(batch_analyses)} ===\n{analysis}"
+            for i, analysis in enumerate(batch_analyses, 1)
+        ))
 
 
 if __name__ == "__main__":